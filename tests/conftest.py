@@ -0,0 +1,43 @@
+import hashlib
+from random import Random
+
+import pytest
+from multiformats import CID
+
+from unix_fs_exporter.resolvers import BlockStore
+
+# multihash code and digest length for sha2-256
+_SHA256_MH_PREFIX = b'\x12\x20'
+
+class MappingBlockStore(BlockStore):
+    def __init__(self, mapping) -> None:
+        self.mapping = mapping
+
+    async def get_block(self, cid: CID) -> bytes:
+        # blocks are keyed by multihash, which the CID holds as is
+        return self.mapping[cid.digest]
+
+@pytest.fixture
+def block_store() -> MappingBlockStore:
+    return MappingBlockStore({})
+
+@pytest.fixture
+def store_block(block_store: MappingBlockStore):
+    def store_block(buf: bytes, codec: int) -> CID:
+        mh = _SHA256_MH_PREFIX + hashlib.sha256(buf).digest()
+        cid = CID('base32', 1, codec, mh)
+        block_store.mapping[mh] = buf
+        return cid
+    return store_block
+
+@pytest.fixture
+def randbytes(request):
+    # seeded per test so payloads do not depend on which tests ran before
+    rng = Random(request.node.name)
+    def randbytes(l: int) -> bytes:
+        # getrandbits(0) raises before python 3.9, and Random.randbytes
+        # only exists from 3.9
+        if l == 0:
+            return b''
+        return rng.getrandbits(l * 8).to_bytes(l, 'little')
+    return randbytes
@@ -0,0 +1,64 @@
+from multiformats import CID, multihash
+
+from unix_fs_exporter.ipfs_dag_pb.dag_pb import PBNode, PBLink, DAGPBFormatException
+from unix_fs_exporter.ipfs_dag_pb.dag_pb_pb2 import PBNode as RawPBNode
+
+def make_cid(buf: bytes) -> CID:
+    return CID('base32', 1, 'raw', multihash.get('sha2-256').digest(buf))
+
+def test_round_trip():
+    original = PBNode(
+        b'some data',
+        [
+            PBLink('a', 5, make_cid(b'a')),
+            PBLink('', 300, make_cid(b'b')),
+            PBLink('été', 0, make_cid(b'c'))
+        ]
+    )
+    encoded = original.encode()
+    decoded = PBNode.decode(encoded)
+    assert decoded == original
+    assert [link.hash_bytes for link in decoded.links] == [bytes(link.cid) for link in original.links]
+
+    raw = RawPBNode()
+    raw.ParseFromString(encoded)
+    assert raw.Data == decoded.data
+    assert [(link.Name, link.Tsize, link.Hash) for link in raw.Links] == [(link.name, link.t_size, link.hash_bytes) for link in decoded.links]
+
+def test_empty():
+    decoded = PBNode.decode(b'')
+    assert decoded.data == b''
+    assert decoded.links == []
+
+def test_unknown_fields_are_skipped():
+    encoded = PBNode(b'data', [PBLink('a', 1, make_cid(b'a'))]).encode()
+    # field 15 as a varint, then as a length delimited field
+    decoded = PBNode.decode(bytes.fromhex('7801') + encoded + bytes.fromhex('7a0100'))
+    assert decoded == PBNode.decode(encoded)
+
+def test_bad():
+    for bad in ('0a05abcd', '12', '1203', '12020a05', '0f', '0200', '12031202ff'):
+        try:
+            PBNode.decode(bytes.fromhex(bad))
+        except DAGPBFormatException:
+            pass
+        else:
+            assert False, bad
+
+def test_link_cids_are_shared():
+    encoded = PBNode(b'', [PBLink('a', 1, make_cid(b'a'))]).encode()
+    first = PBNode.decode(encoded).links[0].cid
+    assert PBNode.decode(encoded).links[0].cid is first
+    assert first == make_cid(b'a')
+
+def test_encode_matches_protobuf():
+    node = PBNode(b'', [PBLink('', 0, make_cid(b'a')), PBLink('b', 1 << 40, make_cid(b'b'))])
+    raw = RawPBNode()
+    for link in node.links:
+        raw_link = raw.Links.add()
+        raw_link.Hash = link.hash_bytes
+        if link.name:
+            raw_link.Name = link.name
+        if link.t_size:
+            raw_link.Tsize = link.t_size
+    assert node.encode() == raw.SerializeToString()
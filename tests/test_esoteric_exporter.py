@@ -1,36 +1,33 @@
 import asyncio
-from random import randint
+import hashlib
+from typing import AsyncIterable
 
+import pytest
 from multiformats import CID, multicodec, multihash
+from hamt_sharding import HAMTBucket
 
-from unix_fs_exporter.exporter import exporter
-from unix_fs_exporter.resolvers import BlockStore, UnixFSFile
+from unix_fs_exporter.exporter import exporter, recursive_exporter, _to_path_components
+from unix_fs_exporter.resolvers import UnixFSFile, RawNode, ResolveException
 from unix_fs_exporter.content import ContentExtractionException
 from unix_fs_exporter.ipfs_dag_pb.dag_pb import PBNode, PBLink
 from unix_fs_exporter.ipfs_unix_fs.unix_fs import UnixFS, FSType
 
-# For python3.7
-def randbytes(l: int) -> bytes:
-    return bytes([randint(0, 0xff) for _ in range(l)])
+RAW_CODE = multicodec.get('raw').code
+DAGPB_CODE = multicodec.get('dag-pb').code
 
-class MappingBlockStore(BlockStore):
-    def __init__(self, mapping) -> None:
-        self.mapping = mapping
+async def collect(content: AsyncIterable[bytes]) -> bytes:
+    buf = bytearray()
+    async for chunk in content:
+        buf += chunk
+    return bytes(buf)
 
-    async def get_block(self, cid: CID) -> bytes:
-        return self.mapping[bytes(cid)]
-
-def test_unbalanced_dag():
-    mapping = {}
-    bs = MappingBlockStore(mapping)
-
-    def store_block(buf: bytes, codec: int) -> CID:
-        mh = multihash.get('sha2-256').digest(buf)
-        cid = CID('base32', 1, codec, mh)
-        assert cid.hashfun.code == multihash.get('sha2-256').code
-        mapping[bytes(cid)] = buf
-        return cid
+def test_store_block(store_block):
+    # checked once here rather than for every block stored
+    cid = store_block(b'block', RAW_CODE)
+    assert cid.hashfun.code == multihash.get('sha2-256').code
+    assert cid.raw_digest == hashlib.sha256(b'block').digest()
 
+def test_unbalanced_dag(block_store, store_block, randbytes):
     raw_blocks = [
         randbytes(5),
         randbytes(3),
@@ -41,7 +38,7 @@ def test_unbalanced_dag():
         randbytes(8)
     ]
 
-    leaves = [(store_block(r, multicodec.get('raw').code), r) for r in raw_blocks]
+    leaf_cids = [store_block(r, RAW_CODE) for r in raw_blocks]
 
     intermediate_node_1 = PBNode(
         UnixFS(
@@ -55,18 +52,18 @@ def test_unbalanced_dag():
             PBLink(
                 '',
                 len(raw_blocks[2]),
-                leaves[2][0]
+                leaf_cids[2]
             ),
             PBLink(
                 '',
                 len(raw_blocks[3]),
-                leaves[3][0]
+                leaf_cids[3]
             )
         ]
     )
 
     intermediate_node_1_buf = intermediate_node_1.encode()
-    intermediate_node_1_cid = store_block(intermediate_node_1_buf, multicodec.get('dag-pb').code)
+    intermediate_node_1_cid = store_block(intermediate_node_1_buf, DAGPB_CODE)
 
     intermediate_node_2 = PBNode(
         UnixFS(
@@ -81,7 +78,7 @@ def test_unbalanced_dag():
             PBLink(
                 '',
                 len(raw_blocks[1]),
-                leaves[1][0]
+                leaf_cids[1]
             ),
             PBLink(
                 '',
@@ -91,13 +88,13 @@ def test_unbalanced_dag():
             PBLink(
                 '',
                 len(raw_blocks[4]),
-                leaves[4][0]
+                leaf_cids[4]
             )
         ]
     )
 
     intermediate_node_2_buf = intermediate_node_2.encode()
-    intermediate_node_2_cid = store_block(intermediate_node_2_buf, multicodec.get('dag-pb').code)
+    intermediate_node_2_cid = store_block(intermediate_node_2_buf, DAGPB_CODE)
 
     unix_fs = UnixFS(
         fs_type=FSType.FILE,
@@ -114,7 +111,7 @@ def test_unbalanced_dag():
             PBLink(
                 '',
                 len(raw_blocks[0]),
-                leaves[0][0]
+                leaf_cids[0]
             ),
             PBLink(
                 '',
@@ -124,158 +121,85 @@ def test_unbalanced_dag():
             PBLink(
                 '',
                 len(raw_blocks[5]),
-                leaves[5][0]
+                leaf_cids[5]
             ),
             PBLink(
                 '',
                 len(raw_blocks[6]),
-                leaves[6][0]
+                leaf_cids[6]
             )
         ]
     )
 
     root_buf = root_node.encode()
-    root_cid = store_block(root_buf, multicodec.get('dag-pb').code)
+    root_cid = store_block(root_buf, DAGPB_CODE)
 
-    exported = asyncio.run(exporter(root_cid, bs))
+    exported = asyncio.run(exporter(root_cid, block_store))
     assert isinstance(exported, UnixFSFile)
-    async def test():
-        chunks = b''
-        async for content in exported.content:
-            chunks += content
-        assert chunks == b''.join(raw_blocks)
-    asyncio.run(test())
-
-def test_deep_dag():
-    mapping = {}
-    bs = MappingBlockStore(mapping)
-
-    def store_block(buf: bytes, codec: int) -> CID:
-        mh = multihash.get('sha2-256').digest(buf)
-        cid = CID('base32', 1, codec, mh)
-        assert cid.hashfun.code == multihash.get('sha2-256').code
-        mapping[bytes(cid)] = buf
-        return cid
+    assert asyncio.run(collect(exported.content)) == b''.join(raw_blocks)
 
+def test_deep_dag(block_store, store_block, randbytes):
     original_buf = randbytes(5)
     buf = original_buf
-    child_cid = store_block(buf, multicodec.get('raw').code)
-    for _ in range(10000):
-        parent = PBNode(
-            UnixFS(
-                fs_type=FSType.FILE,
-                block_sizes=[
-                    len(original_buf)
-                ]
-            ).marshal(),
-            [
-                PBLink(
-                    '',
-                    len(buf),
-                    child_cid,
-                )
-            ]
-        )
-        buf = parent.encode()
-        child_cid = store_block(buf, multicodec.get('dag-pb').code)
-
-    exported = asyncio.run(exporter(child_cid, bs))
-    assert isinstance(exported, UnixFSFile)
-    async def test():
-        chunks = b''
-        async for content in exported.content:
-            chunks += content
-        assert chunks == original_buf
-    asyncio.run(test())
-
-def test_error_on_too_large_block_sizes():
-    mapping = {}
-    bs = MappingBlockStore(mapping)
-
-    def store_block(buf: bytes, codec: int) -> CID:
-        mh = multihash.get('sha2-256').digest(buf)
-        cid = CID('base32', 1, codec, mh)
-        assert cid.hashfun.code == multihash.get('sha2-256').code
-        mapping[bytes(cid)] = buf
-        return cid
-
-    raw_blocks = [
-        randbytes(5),
-        randbytes(3),
-        randbytes(6)
-    ]
-
-    leaves = [(store_block(r, multicodec.get('raw').code), r) for r in raw_blocks]
-
-    unix_fs = UnixFS(
+    child_cid = store_block(buf, RAW_CODE)
+    # every level wraps the same single block, so they all share one UnixFS payload
+    unix_fs_data = UnixFS(
         fs_type=FSType.FILE,
         block_sizes=[
-            len(raw_blocks[0]),
-            len(raw_blocks[1]) + 5,
-            len(raw_blocks[2]),
+            len(original_buf)
         ]
-    )
-    root_node = PBNode(
-        unix_fs.marshal(),
-        [
-            PBLink(
-                '',
-                len(raw_blocks[0]),
-                leaves[0][0]
-            ),
-            PBLink(
-                '',
-                len(raw_blocks[1]),
-                leaves[1][0]
-            ),
-            PBLink(
-                '',
-                len(raw_blocks[2]),
-                leaves[2][0]
-            ),
-        ]
-    )
-    root_buf = root_node.encode()
-    root_cid = store_block(root_buf, multicodec.get('dag-pb').code)
-    exported = asyncio.run(exporter(root_cid, bs))
-
+    ).marshal()
+    # once a parent is as large as its child the encoding only differs in the
+    # child's CID, which is spliced into a copy of that parent from then on
+    template = None
+    for _ in range(10000):
+        if template is None:
+            parent = PBNode(
+                unix_fs_data,
+                [
+                    PBLink(
+                        '',
+                        len(buf),
+                        child_cid,
+                    )
+                ]
+            )
+            parent_buf = parent.encode()
+            if len(parent_buf) == len(buf):
+                template = bytearray(parent_buf)
+                cid_length = len(bytes(child_cid))
+                cid_offset = template.index(bytes(child_cid))
+        else:
+            cid_bytes = bytes(child_cid)
+            assert len(cid_bytes) == cid_length
+            template[cid_offset:cid_offset + cid_length] = cid_bytes
+            parent_buf = bytes(template)
+        buf = parent_buf
+        child_cid = store_block(buf, DAGPB_CODE)
+    assert template is not None
+
+    exported = asyncio.run(exporter(child_cid, block_store))
     assert isinstance(exported, UnixFSFile)
-    async def iter_all():
-        async for _ in exported.content:
-            pass
-    try:
-        asyncio.run(iter_all())
-    except ContentExtractionException:
-        pass
-    else:
-        assert False
-
-def test_error_on_too_small_block_sizes():
-    mapping = {}
-    bs = MappingBlockStore(mapping)
-
-    def store_block(buf: bytes, codec: int) -> CID:
-        mh = multihash.get('sha2-256').digest(buf)
-        cid = CID('base32', 1, codec, mh)
-        assert cid.hashfun.code == multihash.get('sha2-256').code
-        mapping[bytes(cid)] = buf
-        return cid
-
+    assert asyncio.run(collect(exported.content)) == original_buf
+
+# the raw blocks are 5, 3 and 6 bytes long
+@pytest.mark.parametrize('block_sizes', [
+    pytest.param([5, 3 + 5, 6], id='too_large'),
+    pytest.param([5, 3 - 2, 6], id='too_small'),
+    pytest.param([5, 6], id='wrong_number'),
+])
+def test_error_on_bad_block_sizes(block_store, store_block, randbytes, block_sizes):
     raw_blocks = [
         randbytes(5),
         randbytes(3),
         randbytes(6)
     ]
 
-    leaves = [(store_block(r, multicodec.get('raw').code), r) for r in raw_blocks]
+    leaf_cids = [store_block(r, RAW_CODE) for r in raw_blocks]
 
     unix_fs = UnixFS(
         fs_type=FSType.FILE,
-        block_sizes=[
-            len(raw_blocks[0]),
-            len(raw_blocks[1]) - 2,
-            len(raw_blocks[2]),
-        ]
+        block_sizes=block_sizes
     )
     root_node = PBNode(
         unix_fs.marshal(),
@@ -283,23 +207,23 @@ def test_error_on_too_small_block_sizes():
             PBLink(
                 '',
                 len(raw_blocks[0]),
-                leaves[0][0]
+                leaf_cids[0]
             ),
             PBLink(
                 '',
                 len(raw_blocks[1]),
-                leaves[1][0]
+                leaf_cids[1]
             ),
             PBLink(
                 '',
                 len(raw_blocks[2]),
-                leaves[2][0]
+                leaf_cids[2]
             ),
         ]
     )
     root_buf = root_node.encode()
-    root_cid = store_block(root_buf, multicodec.get('dag-pb').code)
-    exported = asyncio.run(exporter(root_cid, bs))
+    root_cid = store_block(root_buf, DAGPB_CODE)
+    exported = asyncio.run(exporter(root_cid, block_store))
 
     assert isinstance(exported, UnixFSFile)
     async def iter_all():
@@ -312,65 +236,143 @@ def test_error_on_too_small_block_sizes():
     else:
         assert False
 
+def test_path_components():
+    assert _to_path_components('a/b//c/') == ['a', 'b', 'c']
+    assert _to_path_components(' a / b\n') == ['a', 'b']
+    assert _to_path_components('a\\/b/c') == ['a\\/b', 'c']
+    assert _to_path_components('a\\b') == ['a', 'b']
+    assert _to_path_components('') == []
 
-def test_error_on_wrong_number_block_sizes():
-    mapping = {}
-    bs = MappingBlockStore(mapping)
+def test_ipfs_path_prefix(block_store, store_block, randbytes):
+    data = randbytes(5)
+    cid = store_block(data, RAW_CODE)
 
-    def store_block(buf: bytes, codec: int) -> CID:
-        mh = multihash.get('sha2-256').digest(buf)
-        cid = CID('base32', 1, codec, mh)
-        assert cid.hashfun.code == multihash.get('sha2-256').code
-        mapping[bytes(cid)] = buf
-        return cid
+    exported = asyncio.run(exporter(f'/ipfs/{cid}', block_store))
+    assert isinstance(exported, RawNode)
+    assert exported.cid == cid
+    assert exported.node == data
 
+def test_resolve_directory_path(block_store, store_block, randbytes):
     raw_blocks = [
         randbytes(5),
-        randbytes(3),
-        randbytes(6)
+        randbytes(3)
     ]
+    leaves = [store_block(r, RAW_CODE) for r in raw_blocks]
 
-    leaves = [(store_block(r, multicodec.get('raw').code), r) for r in raw_blocks]
-
-    unix_fs = UnixFS(
-        fs_type=FSType.FILE,
-        block_sizes=[
-            len(raw_blocks[0]),
-            #len(raw_blocks[1]) + 5,
-            len(raw_blocks[2]),
-        ]
+    inner_dir = PBNode(
+        UnixFS(fs_type=FSType.DIRECTORY).marshal(),
+        [PBLink('b', len(raw_blocks[1]), leaves[1])]
     )
-    root_node = PBNode(
-        unix_fs.marshal(),
+    inner_dir_cid = store_block(inner_dir.encode(), DAGPB_CODE)
+
+    root_dir = PBNode(
+        UnixFS(fs_type=FSType.DIRECTORY).marshal(),
         [
-            PBLink(
-                '',
-                len(raw_blocks[0]),
-                leaves[0][0]
-            ),
-            PBLink(
-                '',
-                len(raw_blocks[1]),
-                leaves[1][0]
-            ),
-            PBLink(
-                '',
-                len(raw_blocks[2]),
-                leaves[2][0]
-            ),
+            PBLink('a', len(raw_blocks[0]), leaves[0]),
+            PBLink('dir', 0, inner_dir_cid)
         ]
     )
-    root_buf = root_node.encode()
-    root_cid = store_block(root_buf, multicodec.get('dag-pb').code)
-    exported = asyncio.run(exporter(root_cid, bs))
+    root_cid = store_block(root_dir.encode(), DAGPB_CODE)
+
+    exported = asyncio.run(exporter(f'/ipfs/{root_cid}/a', block_store))
+    assert isinstance(exported, RawNode)
+    assert exported.cid == leaves[0]
+    assert exported.path == f'{root_cid}/a'
+
+    exported = asyncio.run(exporter(f'{root_cid}/dir/b', block_store))
+    assert isinstance(exported, RawNode)
+    assert exported.node == raw_blocks[1]
 
-    assert isinstance(exported, UnixFSFile)
-    async def iter_all():
-        async for _ in exported.content:
-            pass
     try:
-        asyncio.run(iter_all())
-    except ContentExtractionException:
+        asyncio.run(exporter(f'{root_cid}/missing', block_store))
+    except ResolveException:
         pass
     else:
         assert False
+
+def test_small_files_are_yielded_whole(block_store, store_block, randbytes):
+    def store_file(raw_blocks) -> CID:
+        leaves = [store_block(r, RAW_CODE) for r in raw_blocks]
+        root_node = PBNode(
+            UnixFS(
+                fs_type=FSType.FILE,
+                block_sizes=[len(r) for r in raw_blocks]
+            ).marshal(),
+            [PBLink('', len(r), leaf) for r, leaf in zip(raw_blocks, leaves)]
+        )
+        return store_block(root_node.encode(), DAGPB_CODE)
+
+    async def read(cid: CID):
+        exported = await exporter(cid, block_store)
+        assert isinstance(exported, UnixFSFile)
+        return [content async for content in exported.content]
+
+    small_blocks = [randbytes(10) for _ in range(5)]
+    assert asyncio.run(read(store_file(small_blocks))) == [b''.join(small_blocks)]
+
+    large_blocks = [bytes([i]) * 262144 for i in range(5)]
+    chunks = asyncio.run(read(store_file(large_blocks)))
+    assert len(chunks) > 1
+    assert b''.join(chunks) == b''.join(large_blocks)
+
+def test_resolve_hamt_sharded_directory(block_store, store_block, randbytes):
+    def hash_fn(buf: bytes) -> bytes:
+        # strip the multihash code and length
+        return multihash.get('murmur3-x64-64').digest(buf)[2:]
+
+    def store_shard(bucket: HAMTBucket, fanout: int, pad_length: int) -> CID:
+        links = []
+        for pos, child in sorted(bucket._children.items()):
+            prefix = f'{pos:0{pad_length}X}'
+            if isinstance(child, HAMTBucket):
+                links.append(PBLink(prefix, 0, store_shard(child, fanout, pad_length)))
+            else:
+                links.append(PBLink(prefix + child.key, 0, child.value))
+        shard = PBNode(
+            UnixFS(fs_type=FSType.HAMTSHARD, data=b'\x00', fanout=fanout, hash_type=0x22).marshal(),
+            links
+        )
+        return store_block(shard.encode(), DAGPB_CODE)
+
+    entries = {f'file-{i}': randbytes(4) for i in range(100)}
+    leaves = {name: store_block(buf, RAW_CODE) for name, buf in entries.items()}
+
+    # fanouts of 16 and 256 use one and two character prefixes
+    for bits, pad_length in ((4, 1), (8, 2)):
+        root_bucket = HAMTBucket.create_hamt(hash_fn, bits)
+        for name, leaf in leaves.items():
+            root_bucket[name] = leaf
+        root_cid = store_shard(root_bucket, 2 ** bits, pad_length)
+
+        for name, buf in entries.items():
+            exported = asyncio.run(exporter(f'{root_cid}/{name}', block_store))
+            assert isinstance(exported, RawNode)
+            assert exported.node == buf
+
+        try:
+            asyncio.run(exporter(f'{root_cid}/missing', block_store))
+        except ResolveException:
+            pass
+        else:
+            assert False
+
+def test_recursive_export_of_deep_directories(block_store, store_block):
+    depth = 2000
+    leaf_cid = store_block(b'leaf', RAW_CODE)
+    child_cid = store_block(PBNode(UnixFS(fs_type=FSType.DIRECTORY).marshal(), []).encode(), DAGPB_CODE)
+    for _ in range(depth):
+        parent = PBNode(
+            UnixFS(fs_type=FSType.DIRECTORY).marshal(),
+            [PBLink('a', 0, child_cid), PBLink('b', 4, leaf_cid)]
+        )
+        child_cid = store_block(parent.encode(), DAGPB_CODE)
+
+    async def test():
+        return [entry.path async for entry in recursive_exporter(child_cid, block_store)]
+    paths = asyncio.run(test())
+    assert len(paths) == 2 * depth + 1
+    # entries of a directory come before the rest of its parent's entries
+    assert paths[1] == f'{child_cid}/a'
+    assert paths[2] == f'{child_cid}/a/a'
+    assert paths[-1] == f'{child_cid}/b'
+    assert paths[-2] == f'{child_cid}/a/b'
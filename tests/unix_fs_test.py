@@ -1,15 +1,14 @@
-import os
+from pathlib import Path
 
 from unix_fs_exporter.ipfs_unix_fs.unix_fs import UnixFS, MTime, FSType, DEFAULT_FILE_MODE, DEFAULT_DIRECTORY_MODE, UnixFSFormatException
 from unix_fs_exporter.ipfs_unix_fs.unixfs_pb2 import Data as PBData
 
-dir_path = os.path.dirname(os.path.realpath(__file__))
-fixtures_path = os.path.join(dir_path, 'fixtures/unix_fs')
+fixtures_path = Path(__file__).resolve().parent / 'fixtures' / 'unix_fs'
 
-raw = open(os.path.join(fixtures_path, 'raw.unixfs'), 'rb').read()
-directory = open(os.path.join(fixtures_path, 'directory.unixfs'), 'rb').read()
-file = open(os.path.join(fixtures_path, 'file.txt.unixfs'), 'rb').read()
-symlink = open(os.path.join(fixtures_path, 'symlink.txt.unixfs'), 'rb').read()
+raw = (fixtures_path / 'raw.unixfs').read_bytes()
+directory = (fixtures_path / 'directory.unixfs').read_bytes()
+file = (fixtures_path / 'file.txt.unixfs').read_bytes()
+symlink = (fixtures_path / 'symlink.txt.unixfs').read_bytes()
 
 def test_default_marshaling():
     default_data = PBData()
@@ -245,3 +244,54 @@ def test_bad():
     else:
         assert False
 
+
+def test_file_size_tracks_block_sizes():
+    original = UnixFS(fs_type=FSType.FILE, data=b'abc', block_sizes=[10])
+    assert original.file_size() == 13
+    original.add_block_size(5)
+    assert original.file_size() == 18
+    original.remove_block_size(0)
+    assert original.file_size() == 8
+    assert UnixFS(fs_type=FSType.DIRECTORY, block_sizes=[10]).file_size() == 0
+
+def test_file_size_tracks_direct_changes():
+    original = UnixFS(fs_type=FSType.FILE, data=b'a')
+    message = PBData()
+    message.ParseFromString(original.marshal())
+    assert message.filesize == 1
+    original.data = b'abcdef'
+    original.block_sizes.append(4)
+    assert original.file_size() == 10
+    message.ParseFromString(original.marshal())
+    assert message.filesize == 10
+
+def test_fs_type_from_string():
+    assert FSType.from_string('file') == FSType.FILE
+    assert FSType.from_string('hamt-sharded-directory') == FSType.HAMTSHARD
+    try:
+        FSType.from_string('HAMTSHARD')
+    except ValueError:
+        pass
+    else:
+        assert False
+
+def test_marshal_matches_protobuf():
+    original = UnixFS(
+        fs_type=FSType.HAMTSHARD,
+        data=b'data',
+        block_sizes=[1, 300],
+        hash_type=0x22,
+        fanout=256,
+        m_time=MTime(-5, 1000),
+        mode=0o755
+    )
+    message = PBData()
+    message.Type = PBData.HAMTShard
+    message.Data = b'data'
+    message.blocksizes.extend([1, 300])
+    message.hashType = 0x22
+    message.fanout = 256
+    message.mode = 0o755
+    message.mtime.Seconds = -5
+    message.mtime.FractionalNanoseconds = 1000
+    assert original.marshal() == message.SerializeToString()
@@ -0,0 +1,18 @@
+UINT64_MASK = (1 << 64) - 1
+
+# single byte varints, which cover most lengths and sizes in a node
+_SMALL_VARINTS = tuple(bytes((i,)) for i in range(0x80))
+
+def encode_varint(value: int) -> bytes:
+    if 0 <= value < 0x80:
+        return _SMALL_VARINTS[value]
+    if 0 < value < 0x4000:
+        return bytes((value & 0x7f | 0x80, value >> 7))
+    if not 0 <= value <= UINT64_MASK:
+        raise ValueError(f'Value out of range: {value}')
+    out = bytearray()
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
@@ -1,4 +1,7 @@
-from typing import Mapping, Union, List, Sequence, Callable, TYPE_CHECKING, AsyncIterator, Any
+import asyncio
+
+from collections import deque
+from typing import Deque, Dict, Union, List, Sequence, Tuple, Callable, TYPE_CHECKING, AsyncGenerator, AsyncIterator, Iterator, Any
 
 from multiformats import CID, multicodec
 
@@ -10,41 +13,113 @@ if TYPE_CHECKING:
 
 class ContentExtractionException(Exception): pass
 
-async def _walk_dag(block_store: 'BlockStore', node: PBNode) -> AsyncIterator[bytes]:
-    file = UnixFS.unmarshal(node.data)
+_DAG_PB_CODE = multicodec.get('dag-pb').code
+_RAW_CODE = multicodec.get('raw').code
+
+def _decode_dag_pb(block: bytes) -> Tuple[PBNode, UnixFS]:
+    node = PBNode.decode(block)
+    return node, UnixFS.unmarshal(node.data)
+
+# Number of sibling dag-pb blocks requested from the block store at once.
+_FETCH_BATCH_SIZE = 8
+
+async def _linearize_dag(block_store: 'BlockStore', node: PBNode, file: UnixFS) -> AsyncGenerator[Union[bytes, CID], None]:
+    # Only intermediate nodes are fetched here; this yields their inline
+    # data and the CIDs of the raw leaves in file order.
     if len(file.block_sizes) != len(node.links):
         raise ContentExtractionException('inconsistent block sizes and DAG links')
     yield file.data
-    queue: List[Sequence[PBLink]] = [node.links]
+    # (links, index to resume from, blocks already fetched for them)
+    queue: List[Tuple[Sequence[PBLink], int, Dict[bytes, bytes]]] = [(node.links, 0, {})]
     while True:
         try:
-            links = queue.pop()
+            links, start, fetched = queue.pop()
         except IndexError:
             return
-        for i, link in enumerate(links):
-            block = await block_store.get_block(link.cid)
-            if link.cid.codec.code == multicodec.get('dag-pb').code:
-                node = PBNode.decode(block)
-                file = UnixFS.unmarshal(node.data)
+        for i in range(start, len(links)):
+            link = links[i]
+            code = link.cid.codec.code
+            if code == _DAG_PB_CODE:
+                block = fetched.pop(link.hash_bytes, None)
+                if block is None:
+                    # fetch the next few dag-pb siblings together rather than one at a time
+                    batch = [x for x in links[i:i + _FETCH_BATCH_SIZE] if x.cid.codec.code == _DAG_PB_CODE]
+                    blocks = await asyncio.gather(*(block_store.get_block(x.cid) for x in batch))
+                    fetched.update(zip((x.hash_bytes for x in batch), blocks))
+                    block = fetched.pop(link.hash_bytes)
+                node, file = _decode_dag_pb(block)
                 if len(file.block_sizes) != len(node.links):
                     raise ContentExtractionException('inconsistent block sizes and DAG links')
                 yield file.data
-                defered_links = links[i + 1:]
-                queue.append(defered_links)
-                queue.append(node.links)
+                queue.append((links, i + 1, fetched))
+                queue.append((node.links, 0, {}))
                 break
-            elif link.cid.codec.code == multicodec.get('raw').code:
-                yield block
+            elif code == _RAW_CODE:
+                yield link.cid
+            else:
+                raise ContentExtractionException(f'unsupported codec: {code}')
+
+# Number of chunks (inline data or leaf fetches) kept ahead of the consumer.
+_READ_AHEAD = 8
+
+async def _walk_dag(block_store: 'BlockStore', node: PBNode, file: UnixFS) -> AsyncGenerator[bytes, None]:
+    # leaf fetches are started up to _READ_AHEAD chunks early so block store
+    # latency overlaps with the consumer
+    chunks = _linearize_dag(block_store, node, file)
+    pending: Deque[Union[bytes, 'asyncio.Future[bytes]']] = deque()
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(pending) < _READ_AHEAD:
+                try:
+                    chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    exhausted = True
+                    break
+                if isinstance(chunk, bytes):
+                    pending.append(chunk)
+                else:
+                    pending.append(asyncio.ensure_future(block_store.get_block(chunk)))
+            if not pending:
+                return
+            item = pending.popleft()
+            if isinstance(item, bytes):
+                yield item
             else:
-                raise ContentExtractionException(f'unsupported codec: {link.cid.codec.code}')
+                yield await item
+    finally:
+        for item in pending:
+            if not isinstance(item, bytes):
+                item.cancel()
+        await chunks.aclose()
+
+# Files smaller than this are yielded as a single chunk rather than one per block.
+# The whole file is read before anything is yielded, so a consumer that stops
+# early still pays for every leaf fetch; larger files keep streaming.
+_SMALL_FILE_THRESHOLD = 1 << 20
 
 async def file_content(cid: CID, node: PBNode, unix_fs: UnixFS, path: str, depth: int, block_store: 'BlockStore', resolver: 'Resolver') -> AsyncIterator[bytes]:
     assert unix_fs.fs_type == FSType.FILE
     expected_size = unix_fs.file_size()
     read_length = 0
-    async for chunk in _walk_dag(block_store, node):
-        read_length += len(chunk)
-        yield chunk
+    walker = _walk_dag(block_store, node, unix_fs)
+    try:
+        if expected_size < _SMALL_FILE_THRESHOLD:
+            chunks = []
+            async for chunk in walker:
+                read_length += len(chunk)
+                if read_length > expected_size:
+                    break
+                chunks.append(chunk)
+            if read_length != expected_size:
+                raise ContentExtractionException(f'expected to read {expected_size} but read {read_length}')
+            yield b''.join(chunks)
+            return
+        async for chunk in walker:
+            read_length += len(chunk)
+            yield chunk
+    finally:
+        await walker.aclose()
     if read_length != expected_size:
         raise ContentExtractionException(f'expected to read {expected_size} but read {read_length}')
 
@@ -59,25 +134,36 @@ async def directory_content(cid: CID, node: PBNode, unix_fs: UnixFS, path: str,
         result = await resolver(link.cid, link.name, link_path, [], depth + 1, block_store)
         yield result.entry
 
-async def _list_hamt_directory(node: PBNode, path: str, depth: int, block_store: 'BlockStore', resolver: 'Resolver') -> AsyncIterator['Exportable[Any]']:
-    unix_fs = UnixFS.unmarshal(node.data)
+def _pad_length_from_fanout(fanout: int) -> int:
+    # number of hex digits needed for the largest bucket position, fanout - 1
+    return max(1, ((fanout - 1).bit_length() + 3) // 4)
+
+async def _list_hamt_directory(node: PBNode, unix_fs: UnixFS, path: str, depth: int, block_store: 'BlockStore', resolver: 'Resolver') -> AsyncIterator['Exportable[Any]']:
     if unix_fs.fanout == 0:
         raise ContentExtractionException('no fanout for hamt directory')
-    pad_length = len(hex(unix_fs.fanout - 1)[2:])
-    for link in node.links:
-        name = link.name[pad_length:] if link.name is not None else None
-        if name is not None and name != '':
-            result = await resolver(link.cid, name, f'{path}/{name}', [], depth + 1, block_store)
-            yield result.entry
+    # sub-shards are walked with an explicit stack so deep HAMTs are not
+    # bound by the recursion limit
+    stack: List[Tuple[Iterator[PBLink], int]] = [(iter(node.links), _pad_length_from_fanout(unix_fs.fanout))]
+    while stack:
+        links, pad_length = stack[-1]
+        for link in links:
+            name = link.name[pad_length:]
+            if name:
+                result = await resolver(link.cid, name, f'{path}/{name}', [], depth + 1, block_store)
+                yield result.entry
+            else:
+                block = await block_store.get_block(link.cid)
+                child, child_unix_fs = _decode_dag_pb(block)
+                if child_unix_fs.fanout == 0:
+                    raise ContentExtractionException('no fanout for hamt directory')
+                stack.append((iter(child.links), _pad_length_from_fanout(child_unix_fs.fanout)))
+                break
         else:
-            block = await block_store.get_block(link.cid)
-            node = PBNode.decode(block)
-            async for exportable in _list_hamt_directory(node, path, depth, block_store, resolver):
-                yield exportable
+            stack.pop()
 
 async def hamt_sharded_directory_content(cid: CID, node: PBNode, unix_fs: UnixFS, path: str, depth: int, block_store: 'BlockStore', resolver: 'Resolver') -> AsyncIterator['Exportable[Any]']:
     assert unix_fs.fs_type == FSType.HAMTSHARD
-    async for content in _list_hamt_directory(node, path, depth, block_store, resolver):
+    async for content in _list_hamt_directory(node, unix_fs, path, depth, block_store, resolver):
         yield content
 
 
@@ -87,11 +173,12 @@ async def _null(cid: CID, node: PBNode, unix_fs: UnixFS, path: str, depth: int,
 
 ExportedContent = Union[bytes, 'Exportable[Any]']
 ContentExporter = Callable[[CID, PBNode, UnixFS, str, int, 'BlockStore', 'Resolver'], AsyncIterator[ExportedContent]]
-_CONTENT_EXPORTERS: Mapping[FSType, ContentExporter] = {
-    FSType.RAW: raw_content,
-    FSType.FILE: file_content,
-    FSType.DIRECTORY: directory_content,
-    FSType.HAMTSHARD: hamt_sharded_directory_content,
-    FSType.METADATA: _null,
-    FSType.SYMLINK: _null
-}
+# indexed by FSType.value
+_CONTENT_EXPORTERS: Sequence[ContentExporter] = (
+    raw_content,                     # FSType.RAW
+    directory_content,               # FSType.DIRECTORY
+    file_content,                    # FSType.FILE
+    _null,                           # FSType.METADATA
+    _null,                           # FSType.SYMLINK
+    hamt_sharded_directory_content   # FSType.HAMTSHARD
+)
@@ -1,6 +1,4 @@
-from typing import Union, Sequence, Tuple, AsyncIterable, Any
-
-import re
+from typing import Union, List, Sequence, Tuple, AsyncIterable, AsyncIterator, Any
 
 from multiformats import CID
 
@@ -9,7 +7,35 @@ from .resolvers import resolve, UnixFSDirectory, BlockStore, Exportable
 class ExporterException(Exception): pass
 
 def _to_path_components(path: str) -> Sequence[str]:
-    return [x for x in filter(bool, re.findall(r'(?:[^\\^/]|\\\/)+', ''.join(path.split())))]
+    # components are separated by '/' (or '^') unless the slash is escaped as '\/'
+    path = ''.join(path.split())
+    if '\\' not in path:
+        return [x for x in path.replace('^', '/').split('/') if x]
+
+    components: List[str] = []
+    component: List[str] = []
+    escaped = False
+    for c in path:
+        if escaped:
+            escaped = False
+            if c == '/':
+                component.append('\\/')
+                continue
+            # a backslash that does not escape a slash separates components
+            if component:
+                components.append(''.join(component))
+                component.clear()
+        if c == '\\':
+            escaped = True
+        elif c in '/^':
+            if component:
+                components.append(''.join(component))
+                component.clear()
+        else:
+            component.append(c)
+    if component:
+        components.append(''.join(component))
+    return components
 
 def _cid_and_rest(path: Union[str, bytes, CID]) -> Tuple[CID, Sequence[str]]:
     if isinstance(path, bytes):
@@ -19,7 +45,7 @@ def _cid_and_rest(path: Union[str, bytes, CID]) -> Tuple[CID, Sequence[str]]:
     
     try:
         return CID.decode(path), []
-    except ValueError:
+    except (ValueError, KeyError):
         pass
 
     if not isinstance(path, str):
@@ -51,13 +77,18 @@ async def exporter(path: Union[str, CID], block_store: BlockStore) -> Exportable
     return result
 
 async def _recurse(node: UnixFSDirectory) -> AsyncIterable[Exportable[Any]]:
-    async for file in node.content:
-        yield file
-        if isinstance(file, bytes):
+    # listings of the directories being walked, innermost last; entries are
+    # yielded in the same depth first order as a recursive walk
+    stack: List[AsyncIterator[Exportable[Any]]] = [node.content.__aiter__()]
+    while stack:
+        try:
+            entry = await stack[-1].__anext__()
+        except StopAsyncIteration:
+            stack.pop()
             continue
-        if isinstance(file, UnixFSDirectory):
-            async for content in _recurse(file):
-                yield content
+        yield entry
+        if isinstance(entry, UnixFSDirectory):
+            stack.append(entry.content.__aiter__())
 
 async def recursive_exporter(path: Union[str, CID], block_store: BlockStore) -> AsyncIterable[Exportable[Any]]:
     node = await exporter(path, block_store)
@@ -1,19 +1,139 @@
 import attr
 
-from typing import Sequence
+from weakref import WeakValueDictionary
+from typing import Optional, Sequence, List, Tuple
 
-from google.protobuf.message import DecodeError  # type: ignore
 from multiformats import CID
 
-from . import dag_pb_pb2 as pb2
+from .._varint import encode_varint, UINT64_MASK
 
 class DAGPBFormatException(Exception): pass
 
+# field tags (field number << 3 | wire type) of the DAG-PB schema
+_NODE_DATA = 0x0a
+_NODE_LINKS = 0x12
+_LINK_HASH = 0x0a
+_LINK_NAME = 0x12
+_LINK_TSIZE = 0x18
+
+def _read_varint(buf: bytes, pos: int) -> Tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result & UINT64_MASK, pos
+        shift += 7
+        if shift >= 64:
+            raise DAGPBFormatException('too many bytes when decoding varint')
+
+def _skip_field(buf: bytes, pos: int, tag: int) -> int:
+    wire_type = tag & 7
+    if wire_type == 0:
+        return _read_varint(buf, pos)[1]
+    if wire_type == 1:
+        return pos + 8
+    if wire_type == 2:
+        length, pos = _read_varint(buf, pos)
+        return pos + length
+    if wire_type == 3:
+        while True:
+            tag, pos = _read_varint(buf, pos)
+            if tag & 7 == 4:
+                return pos
+            pos = _skip_field(buf, pos, tag)
+    if wire_type == 5:
+        return pos + 4
+    raise DAGPBFormatException(f'unsupported wire type {wire_type}')
+
+def _skip_unknown_field(buf: bytes, pos: int, tag: int) -> int:
+    if tag >> 3 == 0:
+        raise DAGPBFormatException('invalid field number 0')
+    return _skip_field(buf, pos, tag)
+
+def _scan_pbnode(raw: bytes) -> Tuple[bytes, List[Tuple[str, int, bytes]]]:
+    # The DAG-PB schema only has two node fields and three link fields, so
+    # they are read in a single pass instead of building protobuf messages.
+    data = b''
+    links = []
+    end = len(raw)
+    pos = 0
+    try:
+        while pos < end:
+            tag = raw[pos]
+            if tag < 0x80:
+                pos += 1
+            else:
+                tag, pos = _read_varint(raw, pos)
+            if tag == _NODE_LINKS:
+                length, pos = _read_varint(raw, pos)
+                link_end = pos + length
+                if link_end > end:
+                    raise DAGPBFormatException('truncated link')
+                hash_bytes = b''
+                name = ''
+                t_size = 0
+                while pos < link_end:
+                    tag = raw[pos]
+                    if tag < 0x80:
+                        pos += 1
+                    else:
+                        tag, pos = _read_varint(raw, pos)
+                    if tag == _LINK_HASH:
+                        length, pos = _read_varint(raw, pos)
+                        hash_bytes = raw[pos:pos + length]
+                        pos += length
+                    elif tag == _LINK_NAME:
+                        length, pos = _read_varint(raw, pos)
+                        name = raw[pos:pos + length].decode()
+                        pos += length
+                    elif tag == _LINK_TSIZE:
+                        t_size, pos = _read_varint(raw, pos)
+                    else:
+                        pos = _skip_unknown_field(raw, pos, tag)
+                if pos != link_end:
+                    raise DAGPBFormatException('truncated link')
+                links.append((name, t_size, hash_bytes))
+            elif tag == _NODE_DATA:
+                length, pos = _read_varint(raw, pos)
+                data = raw[pos:pos + length]
+                pos += length
+            else:
+                pos = _skip_unknown_field(raw, pos, tag)
+        if pos != end:
+            raise DAGPBFormatException('truncated node')
+    except (IndexError, UnicodeDecodeError) as e:
+        raise DAGPBFormatException() from e
+    return data, links
+
+# links to shared subtrees and HAMT shards repeat across nodes; while a CID for
+# some hash is alive, decoding that hash again hands back the same object
+_CID_CACHE: 'WeakValueDictionary[bytes, CID]' = WeakValueDictionary()
+
+def _decode_cid(hash_bytes: bytes) -> CID:
+    cid = _CID_CACHE.get(hash_bytes)
+    if cid is None:
+        cid = CID.decode(hash_bytes)
+        _CID_CACHE[hash_bytes] = cid
+    return cid
+
 @attr.define(slots=True, frozen=True)
 class PBLink:
     name: str
     t_size: int
-    cid: CID
+    _cid: Optional[CID] = attr.field(default=None, eq=False, repr=False)
+    # binary encoding of the cid, as stored in the Hash field on the wire
+    hash_bytes: bytes = attr.field(default=attr.Factory(lambda self: bytes(self._cid), takes_self=True))
+
+    @property
+    def cid(self) -> CID:
+        # decoded links only carry the raw Hash; most of them are never followed
+        if self._cid is None:
+            object.__setattr__(self, '_cid', _decode_cid(self.hash_bytes))
+        assert self._cid is not None
+        return self._cid
 
 @attr.define(slots=True, frozen=True)
 class PBNode:
@@ -22,33 +142,35 @@ class PBNode:
 
     @classmethod
     def decode(cls, raw: bytes) -> 'PBNode':
-        raw_node = pb2.PBNode()
-        try:
-            raw_node.ParseFromString(raw)
-        except DecodeError:
-            raise DAGPBFormatException()
+        data, links = _scan_pbnode(bytes(raw))
         return PBNode(
-            data=raw_node.Data,
-            links=[PBLink(
-                name=link.Name,
-                t_size=link.Tsize,
-                cid=CID.decode(link.Hash)
-            ) for link in raw_node.Links]
+            data=data,
+            # positional arguments keep per-link construction cheap on wide nodes
+            links=[PBLink(name, t_size, None, hash_bytes) for name, t_size, hash_bytes in links]
         )
 
     def encode(self) -> bytes:
-        node = pb2.PBNode()
-        if self.data != pb2._PBNODE.fields_by_name['Data'].default_value:
-            node.Data = self.data
-        if self.links != pb2._PBNODE.fields_by_name['Links'].default_value:
-            for link in self.links:
-                pb_link = pb2.PBLink()
-                if link.name != pb2._PBLINK.fields_by_name['Name'].default_value:
-                    pb_link.Name = link.name
-                if link.t_size != pb2._PBLINK.fields_by_name['Tsize'].default_value:
-                    pb_link.Tsize = link.t_size
-                if bytes(link.cid) != pb2._PBLINK.fields_by_name['Hash'].default_value:
-                    pb_link.Hash = bytes(link.cid)
-                node.Links.append(pb_link)
-
-        return node.SerializeToString() # type: ignore
+        # fields are written in field number order, as protobuf would, skipping defaults
+        out = bytearray()
+        if self.data:
+            out.append(_NODE_DATA)
+            out += encode_varint(len(self.data))
+            out += self.data
+        for link in self.links:
+            encoded_link = bytearray()
+            if link.hash_bytes:
+                encoded_link.append(_LINK_HASH)
+                encoded_link += encode_varint(len(link.hash_bytes))
+                encoded_link += link.hash_bytes
+            if link.name:
+                name = link.name.encode()
+                encoded_link.append(_LINK_NAME)
+                encoded_link += encode_varint(len(name))
+                encoded_link += name
+            if link.t_size:
+                encoded_link.append(_LINK_TSIZE)
+                encoded_link += encode_varint(link.t_size)
+            out.append(_NODE_LINKS)
+            out += encode_varint(len(encoded_link))
+            out += encoded_link
+        return bytes(out)
@@ -5,9 +5,25 @@ from typing import Optional, List
 
 from . import unixfs_pb2 as pb2
 from google.protobuf.message import DecodeError  # type: ignore
+from .._varint import encode_varint, UINT64_MASK
 
 class UnixFSFormatException(Exception): pass
 
+_UINT32_MASK = (1 << 32) - 1
+_INT64_LIMIT = 1 << 63
+
+# field tags (field number << 3 | wire type) of the UnixFS Data and UnixTime messages
+_DATA_TYPE = 0x08
+_DATA_DATA = 0x12
+_DATA_FILESIZE = 0x18
+_DATA_BLOCKSIZES = 0x22
+_DATA_HASH_TYPE = 0x28
+_DATA_FANOUT = 0x30
+_DATA_MODE = 0x38
+_DATA_MTIME = 0x42
+_UNIXTIME_SECONDS = 0x08
+_UNIXTIME_FRACTIONAL_NANOSECONDS = 0x15
+
 @attr.define(slots=True, frozen=True)
 class MTime:
     seconds: int
@@ -23,25 +39,27 @@ class FSType(Enum):
 
     @classmethod
     def from_string(cls, s: str) -> 'FSType':
-        if s == 'raw':
-            return cls.RAW
-        if s == 'directory':
-            return cls.DIRECTORY
-        if s == 'file':
-            return cls.FILE
-        if s == 'metadata':
-            return cls.METADATA
-        if s == 'symlink':
-            return cls.SYMLINK
-        if s == 'hamt-sharded-directory':
-            return cls.HAMTSHARD
-        raise ValueError()
-    
+        fs_type = _FS_TYPE_FROM_STRING.get(s)
+        if fs_type is None:
+            raise ValueError()
+        return fs_type
+
+_FS_TYPE_FROM_STRING = {
+    'raw': FSType.RAW,
+    'directory': FSType.DIRECTORY,
+    'file': FSType.FILE,
+    'metadata': FSType.METADATA,
+    'symlink': FSType.SYMLINK,
+    'hamt-sharded-directory': FSType.HAMTSHARD
+}
+
 DIR_TYPES = (FSType.DIRECTORY, FSType.HAMTSHARD)
 DEFAULT_FILE_MODE = int('0644', base=8)
 DEFAULT_DIRECTORY_MODE = int('0755', base=8)
 
 class UnixFS:
+    __slots__ = ('fs_type', 'data', 'block_sizes', 'hash_type', 'fanout', 'm_time', '_original_mode', '_mode')
+
     def __init__(self, *,
                  fs_type: FSType = FSType.RAW,
                  data: Optional[bytes] = None,
@@ -78,8 +96,7 @@ class UnixFS:
     
     def file_size(self) -> int:
         if self.is_dir(): return 0
-        total = sum(s for s in self.block_sizes)
-        return len(self.data) + total
+        return len(self.data) + sum(self.block_sizes)
     
     def add_block_size(self, size: int) -> None:
         self.block_sizes.append(size)
@@ -107,31 +124,55 @@ class UnixFS:
         return fs
 
     def marshal(self) -> bytes:
-        message = pb2.Data()
-
-        if self.fs_type.value != pb2._DATA.fields_by_name['Type'].default_value:
-            message.Type = self.fs_type.value
-        if self.data != pb2._DATA.fields_by_name['Data'].default_value:
-            message.Data = self.data
-        if self.block_sizes != pb2._DATA.fields_by_name['blocksizes'].default_value:
-            message.blocksizes.extend(self.block_sizes)
-        if self.hash_type != pb2._DATA.fields_by_name['hashType'].default_value:
-            message.hashType = self.hash_type
-        if self.fanout != pb2._DATA.fields_by_name['fanout'].default_value:
-            message.fanout = self.fanout
-        
-        if self.m_time.seconds != pb2._UNIXTIME.fields_by_name['Seconds'].default_value:
-            message.mtime.Seconds = self.m_time.seconds
-        if self.m_time.nano_seconds != pb2._UNIXTIME.fields_by_name['FractionalNanoseconds'].default_value:
-            message.mtime.FractionalNanoseconds = self.m_time.nano_seconds
-
-        mode = self.mode
-        if self._original_mode:
-            mode = self._original_mode
-        if self._original_mode or mode != pb2._DATA.fields_by_name['mode'].default_value:
-            message.mode = mode
-
-        if self.file_size() != pb2._DATA.fields_by_name['filesize'].default_value:
-            message.filesize = self.file_size()
-
-        return message.SerializeToString()  # type: ignore
+        # same layout protobuf produces: ascending field numbers, unset fields omitted
+        out = bytearray()
+        if self.fs_type.value:
+            out.append(_DATA_TYPE)
+            out += encode_varint(self.fs_type.value)
+        if self.data:
+            out.append(_DATA_DATA)
+            out += encode_varint(len(self.data))
+            out += self.data
+        file_size = self.file_size()
+        if file_size:
+            out.append(_DATA_FILESIZE)
+            out += encode_varint(file_size)
+        if self.block_sizes:
+            packed = b''.join(encode_varint(size) for size in self.block_sizes)
+            out.append(_DATA_BLOCKSIZES)
+            out += encode_varint(len(packed))
+            out += packed
+        if self.hash_type:
+            out.append(_DATA_HASH_TYPE)
+            out += encode_varint(self.hash_type)
+        if self.fanout:
+            out.append(_DATA_FANOUT)
+            out += encode_varint(self.fanout)
+
+        mode = self._original_mode or self.mode
+        if mode:
+            if mode > _UINT32_MASK:
+                raise ValueError(f'Value out of range: {mode}')
+            out.append(_DATA_MODE)
+            out += encode_varint(mode)
+
+        seconds = self.m_time.seconds
+        nano_seconds = self.m_time.nano_seconds
+        if seconds or nano_seconds:
+            m_time = bytearray()
+            if seconds:
+                if not -_INT64_LIMIT <= seconds < _INT64_LIMIT:
+                    raise ValueError(f'Value out of range: {seconds}')
+                # negative int64 values are written as their 64 bit two's complement
+                m_time.append(_UNIXTIME_SECONDS)
+                m_time += encode_varint(seconds & UINT64_MASK)
+            if nano_seconds:
+                if not 0 <= nano_seconds <= _UINT32_MASK:
+                    raise ValueError(f'Value out of range: {nano_seconds}')
+                m_time.append(_UNIXTIME_FRACTIONAL_NANOSECONDS)
+                m_time += nano_seconds.to_bytes(4, 'little')
+            out.append(_DATA_MTIME)
+            out += encode_varint(len(m_time))
+            out += m_time
+
+        return bytes(out)
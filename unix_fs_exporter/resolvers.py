@@ -6,12 +6,13 @@ from math import log2
 from typing import Generic, TypeVar, Sequence, Union, Optional, Mapping, Callable, AsyncIterable, Awaitable, Any
 
 import dag_cbor
+import mmh3
 from multiformats import CID, multicodec, multihash
 
 from hamt_sharding import HAMTBucket
 from hamt_sharding.buckets import HAMTBucketPosition
 
-from .content import _CONTENT_EXPORTERS, ExportedContent
+from .content import _CONTENT_EXPORTERS, _decode_dag_pb, _pad_length_from_fanout, ExportedContent
 from .ipfs_unix_fs.unix_fs import UnixFS, FSType
 from .ipfs_dag_pb.dag_pb import PBNode, PBLink
 
@@ -19,9 +20,15 @@ T = TypeVar('T')
 
 class ResolveException(Exception): pass
 
+_DAG_PB_CODE = multicodec.get('dag-pb').code
+_RAW_CODE = multicodec.get('raw').code
+_DAG_CBOR_CODE = multicodec.get('dag-cbor').code
+_IDENTITY_CODE = multicodec.get('identity').code
+
 class BlockStore(ABC):
     @abstractmethod
     async def get_block(self, cid: CID) -> bytes:
+        # called for every block visited; key stores by cid.digest rather than cid.encode()
         pass
 
 async def _iterable_to_async_iterable(x: Sequence[T]) -> AsyncIterable[T]:
@@ -29,6 +36,8 @@ async def _iterable_to_async_iterable(x: Sequence[T]) -> AsyncIterable[T]:
         yield y
 
 class Exportable(ABC, Generic[T]):
+    __slots__ = ('name', 'path', 'cid', 'depth', 'size', 'content', 'node')
+
     def __init__(self, 
                  name: str,
                  path: str,
@@ -46,6 +55,8 @@ class Exportable(ABC, Generic[T]):
         self.node = node
     
 class FSExportable(Exportable[T]):
+    __slots__ = ('unix_fs',)
+
     def __init__(self,
                  unix_fs: UnixFS,
                  node: PBNode,
@@ -59,6 +70,8 @@ class FSExportable(Exportable[T]):
         self.unix_fs = unix_fs
 
 class UnixFSFile(FSExportable[bytes]):
+    __slots__ = ()
+
     def __init__(self,
                  unix_fs: UnixFS,
                  node: PBNode,
@@ -71,6 +84,8 @@ class UnixFSFile(FSExportable[bytes]):
         FSExportable.__init__(self, unix_fs, node, name, path, cid, depth, size, content)
 
 class UnixFSDirectory(FSExportable[Exportable[Any]]):
+    __slots__ = ()
+
     def __init__(self,
                  unix_fs: UnixFS,
                  node: PBNode,
@@ -83,6 +98,8 @@ class UnixFSDirectory(FSExportable[Exportable[Any]]):
         FSExportable.__init__(self, unix_fs, node, name, path, cid, depth, size, content)
 
 class BinaryExportable(FSExportable[T]):
+    __slots__ = ()
+
     def __init__(self,
                  node: bytes,
                  name: str,
@@ -94,6 +111,8 @@ class BinaryExportable(FSExportable[T]):
         Exportable.__init__(self, name, path, cid, depth, size, node, content)
 
 class ObjectNode(BinaryExportable[object]):
+    __slots__ = ()
+
     def __init__(self,
                  node: bytes,
                  name: str,
@@ -105,6 +124,8 @@ class ObjectNode(BinaryExportable[object]):
         BinaryExportable.__init__(self, node, name, path, cid, depth, size, content)
 
 class RawNode(BinaryExportable[bytes]):
+    __slots__ = ()
+
     def __init__(self,
                  node: bytes,
                  name: str,
@@ -116,6 +137,8 @@ class RawNode(BinaryExportable[bytes]):
         BinaryExportable.__init__(self, node, name, path, cid, depth, size, content)
 
 class IdentityNode(BinaryExportable[bytes]):
+    __slots__ = ()
+
     def __init__(self,
                  node: bytes,
                  name: str,
@@ -232,20 +255,26 @@ class _ShardTraversalContext:
     root_bucket: HAMTBucket[str, bool]
     last_bucket: HAMTBucket[str, bool]
 
+_MURMUR3_X64_64_CODE = 0x22
+
+def _murmur3_x64_64(buf: bytes) -> bytes:
+    # the first 8 bytes of the big-endian unsigned 128 bit hash, i.e. its high 64 bits
+    return mmh3.hash64(buf, signed=False)[1].to_bytes(8, 'big')
+
 def _pad_length(bucket: HAMTBucket[str, bool]) -> int:
-    return len(hex(bucket.table_size - 1)[2:])
+    return _pad_length_from_fanout(bucket.table_size)
 
 def _add_links_to_hamt_bucket(links: Sequence[PBLink], bucket: HAMTBucket[str, bool], root_bucket: HAMTBucket[str, bool]) -> None:
     pad_length = _pad_length(bucket)
     for link in links:
         if len(link.name) == pad_length:
             pos = int(link.name, 16)
-            bucket._put_object_at(pos, HAMTBucket[str, bool](root_bucket._bits, root_bucket._infinite_wrapper))
+            bucket._put_object_at(pos, HAMTBucket[str, bool](root_bucket._bits, root_bucket._infinite_wrapper, bucket, pos))
         else:
-            root_bucket[link.name[:2]] = True
+            root_bucket[link.name[pad_length:]] = True
 
 def _to_prefix(position: int, pad_length: int) -> str:
-    return hex(position)[2:].upper().zfill(pad_length)[:pad_length]
+    return f'{position:0{pad_length}X}'
 
 def _to_bucket_path(position: HAMTBucketPosition[str, bool]) -> Sequence[HAMTBucket[str, bool]]:
     bucket = position.bucket
@@ -256,75 +285,70 @@ def _to_bucket_path(position: HAMTBucketPosition[str, bool]) -> Sequence[HAMTBuc
     path.append(bucket)
     return path[::-1]
 
-async def _find_shard_cid(node: PBNode, name: str, block_store: BlockStore, context: Optional[_ShardTraversalContext] = None) -> Optional[CID]:
-    if context is None:
-        if not node.data:
-            raise ResolveException('no data in shard node')
-        unix_fs = UnixFS.unmarshal(node.data)
-        if unix_fs.fs_type != FSType.HAMTSHARD:
-            raise ResolveException(f'not an HAMT sharded directory (is {unix_fs.fs_type})')
-        if unix_fs.fanout == 0:
-            raise ResolveException('not a valid fanout')
-
-        def _hash_fn(buf: bytes) -> bytes:
-            # TODO: Remove this once multihash gets fixed
-            if unix_fs.hash_type == 0x22:
-                from multiformats.multihash._hashfuns.murmur3 import _murmur3
-                return _murmur3('x64', 64)(buf)
-            mh = multihash.get(code=unix_fs.hash_type)
-            assert mh
-            return mh.digest(buf)
-
-        log_2 = log2(unix_fs.fanout)
-        if not log_2.is_integer():
-            raise ResolveException(f'fanout should be an exponent of 2 (is {unix_fs.fanout})')
-        root_bucket = HAMTBucket[str, bool].create_hamt(_hash_fn, int(log_2))
-        context = _ShardTraversalContext(1, root_bucket, root_bucket)
-
-    pad_length = _pad_length(context.last_bucket)
-    _add_links_to_hamt_bucket(node.links, context.last_bucket, context.root_bucket)
-    position = context.root_bucket._find_new_bucket_and_pos(name)
-    prefix = _to_prefix(position.pos, pad_length)
-    bucket_path = _to_bucket_path(position)
-    if len(bucket_path) > context.hamt_depth:
-        context.last_bucket = bucket_path[context.hamt_depth]
-        prefix = _to_prefix(context.last_bucket._pos_at_parent, pad_length)
-
-    def predicate(link: PBLink) -> bool:
-        entry_prefix = link.name[:pad_length]
-        entry_name = link.name[pad_length:]
-        if entry_prefix != prefix:
-            return False
-        if entry_name != '' and entry_name != name:
-            return False
-        return True
-
-    link = next(filter(predicate, node.links), None)
-    if link is None: return None
-    if link.name[pad_length:] == name:
-        return link.cid
-    
-    context.hamt_depth += 1
-    block = await block_store.get_block(link.cid)
-    node = PBNode.decode(block)
-    return await _find_shard_cid(node, name, block_store, context)
+async def _find_shard_cid(node: PBNode, unix_fs: UnixFS, name: str, block_store: BlockStore) -> Optional[CID]:
+    if not node.data:
+        raise ResolveException('no data in shard node')
+    if unix_fs.fs_type != FSType.HAMTSHARD:
+        raise ResolveException(f'not an HAMT sharded directory (is {unix_fs.fs_type})')
+    if unix_fs.fanout == 0:
+        raise ResolveException('not a valid fanout')
+
+    hash_fn: Callable[[bytes], bytes]
+    if unix_fs.hash_type == _MURMUR3_X64_64_CODE:
+        hash_fn = _murmur3_x64_64
+    else:
+        mh = multihash.get(code=unix_fs.hash_type)
+        assert mh
+        hash_fn = mh.digest
+
+    log_2 = log2(unix_fs.fanout)
+    if not log_2.is_integer():
+        raise ResolveException(f'fanout should be an exponent of 2 (is {unix_fs.fanout})')
+    root_bucket = HAMTBucket[str, bool].create_hamt(hash_fn, int(log_2))
+    context = _ShardTraversalContext(1, root_bucket, root_bucket)
+
+    # each iteration descends one shard, so every block on the path is fetched and decoded once
+    while True:
+        pad_length = _pad_length(context.last_bucket)
+        _add_links_to_hamt_bucket(node.links, context.last_bucket, context.root_bucket)
+        position = context.root_bucket._find_new_bucket_and_pos(name)
+        prefix = _to_prefix(position.pos, pad_length)
+        bucket_path = _to_bucket_path(position)
+        if len(bucket_path) > context.hamt_depth:
+            context.last_bucket = bucket_path[context.hamt_depth]
+            prefix = _to_prefix(context.last_bucket._pos_at_parent, pad_length)
+
+        def predicate(link: PBLink) -> bool:
+            if not link.name.startswith(prefix):
+                return False
+            entry_name = link.name[pad_length:]
+            return entry_name == '' or entry_name == name
+
+        link = next(filter(predicate, node.links), None)
+        if link is None: return None
+        # a matching link longer than its prefix is the entry itself, otherwise it is a sub-shard
+        if len(link.name) > pad_length:
+            return link.cid
+
+        context.hamt_depth += 1
+        block = await block_store.get_block(link.cid)
+        node, _ = _decode_dag_pb(block)
 
 async def resolve_dag_pb(cid: CID, name: str, path: str, to_resolve: Sequence[str], depth: int, block_store: BlockStore) -> ResolveResult:
     block = await block_store.get_block(cid)
-    node = PBNode.decode(block)
+    node, unix_fs = _decode_dag_pb(block)
 
     name = name or cid.encode()
     path = path or name
 
-    unix_fs = UnixFS.unmarshal(node.data)
     next_result = None
 
     if len(to_resolve) > 0:
         link_cid = None
         if unix_fs.fs_type == FSType.HAMTSHARD:
-            link_cid = await _find_shard_cid(node, to_resolve[0], block_store)
+            link_cid = await _find_shard_cid(node, unix_fs, to_resolve[0], block_store)
         else:
-            link = next(filter(lambda x: x.name == name, node.links), None)
+            link = next((link for link in node.links if link.name == to_resolve[0]), None)
             if link is not None:
                 link_cid = link.cid
         if link_cid is None:
@@ -340,7 +364,7 @@ async def resolve_dag_pb(cid: CID, name: str, path: str, to_resolve: Sequence[st
             to_resolve[1:],
         )
 
-    content = _CONTENT_EXPORTERS[unix_fs.fs_type](cid, node, unix_fs, path, depth, block_store, resolve)
+    content = _CONTENT_EXPORTERS[unix_fs.fs_type.value](cid, node, unix_fs, path, depth, block_store, resolve)
     if unix_fs.is_dir():
 
         async def validate_directory_results(content: AsyncIterable[ExportedContent]) -> AsyncIterable[Exportable[Any]]:
@@ -382,10 +406,10 @@ async def resolve_dag_pb(cid: CID, name: str, path: str, to_resolve: Sequence[st
     )
 
 _CONTENT_RESOLVERS: Mapping[int, Resolver] = {
-    multicodec.get('dag-pb').code: resolve_dag_pb,
-    multicodec.get('raw').code: resolve_raw,
-    multicodec.get('dag-cbor').code: resolve_dag_cbor,
-    multicodec.get('identity').code: resolve_identity
+    _DAG_PB_CODE: resolve_dag_pb,
+    _RAW_CODE: resolve_raw,
+    _DAG_CBOR_CODE: resolve_dag_cbor,
+    _IDENTITY_CODE: resolve_identity
 }
 
 def resolve(cid: CID, name: str, path: str, to_resolve: Sequence[str], depth: int, block_store: BlockStore) -> Awaitable[ResolveResult]: